@@ -0,0 +1,141 @@
+import re
+import hashlib
+
+CLIENT_SELECTOR_RE = re.compile(r'client_name="((?:[^"\\]|\\.)*)"')
+
+
+class AccessPolicyIndex:
+    # Packs many clients into a few shared access policies, one label selector per client.
+    # Clients are grouped by region and scopes, each policy holds at most max_selectors clients.
+    # The index is built from a single access policy listing per region and is then updated
+    # in memory; only policies whose selectors changed are written back by sync().
+    def __init__(self, cloud_api, realm_identifier, name_prefix, logger, realm_type="stack", max_selectors=10):
+        self.cloud_api = cloud_api
+        self.realm_identifier = realm_identifier
+        self.realm_type = realm_type
+        self.name_prefix = name_prefix
+        self.logger = logger
+        self.max_selectors = max_selectors
+        self.policies = {}          # policy name -> {"id", "region", "scopes", "selectors": {client name: selector}}
+        self.client_policy = {}     # client name -> policy name
+        self.tokens = {}            # policy name -> token created during this run
+        self.token_names = {}       # policy name -> name of that token
+        self.retired_tokens = {}    # policy name -> (id, region) of the tokens it replaced, deleted by retire_tokens()
+        self.dirty = set()
+        self.loaded_regions = set()
+
+    def load(self, region):
+        if region in self.loaded_regions: return
+        existing_access_policies = self.cloud_api.get_access_policies(realmType=self.realm_type,realmIdentifier=self.realm_identifier,region=region)
+        name_pattern = self.policy_name_pattern(region)
+        for access_policy in existing_access_policies["items"]:
+            # Per-client policies can share the prefix, e.g. client "Clients R Us", only generated names are ours
+            if not name_pattern.match(access_policy["name"]): continue
+            selectors = {}
+            for realm in access_policy.get("realms", []):
+                for label_policy in realm.get("labelPolicies") or []:
+                    match = CLIENT_SELECTOR_RE.search(label_policy["selector"])
+                    if match: selectors[match.group(1)] = label_policy["selector"]
+            self.policies[access_policy["name"]] = {"id": access_policy["id"], "region": region, "scopes": sorted(access_policy["scopes"]), "selectors": selectors}
+            for client_name in selectors: self.client_policy[client_name] = access_policy["name"]
+        self.loaded_regions.add(region)
+        self.logger.debug(f"Loaded {len(self.policies)} consolidated access policies for region {region}")
+
+    def scope_hash(self, scopes):
+        return hashlib.sha1(",".join(sorted(scopes)).encode()).hexdigest()[:8]
+
+    def group_prefix(self, region, scopes):
+        return f"{self.name_prefix}-{region}-{self.scope_hash(scopes)}"
+
+    def policy_name_pattern(self, region, scopes=None):
+        # Matches only the names assign() generates: {prefix}-{region}-{scope hash}-{n}
+        scope_hash = self.scope_hash(scopes) if scopes is not None else "[0-9a-f]{8}"
+        return re.compile(f"^{re.escape(self.name_prefix)}-{re.escape(region)}-{scope_hash}-[0-9]+$")
+
+    def assign(self, client_name, selector, region, scopes):
+        # Returns the policy the client's selector lives in, moving it if its region or scopes changed
+        self.load(region)
+        scopes = sorted(scopes)
+        policy_name = self.client_policy.get(client_name)
+        if policy_name is not None:
+            policy = self.policies[policy_name]
+            if policy["region"] == region and policy["scopes"] == scopes:
+                if policy["selectors"][client_name] != selector:
+                    policy["selectors"][client_name] = selector
+                    self.dirty.add(policy_name)
+                return policy_name
+            self.remove(client_name)
+
+        group_prefix = self.group_prefix(region, scopes)
+        group_pattern = self.policy_name_pattern(region, scopes)
+        group = sorted(name for name, policy in self.policies.items() if group_pattern.match(name) and policy["region"] == region and policy["scopes"] == scopes)
+        policy_name = next((name for name in group if len(self.policies[name]["selectors"]) < self.max_selectors), None)
+        if policy_name is None:
+            index = 1
+            while f"{group_prefix}-{index}" in self.policies: index += 1
+            policy_name = f"{group_prefix}-{index}"
+            self.policies[policy_name] = {"id": None, "region": region, "scopes": scopes, "selectors": {}}
+        self.policies[policy_name]["selectors"][client_name] = selector
+        self.client_policy[client_name] = policy_name
+        self.dirty.add(policy_name)
+        return policy_name
+
+    def remove(self, client_name):
+        policy_name = self.client_policy.pop(client_name, None)
+        if policy_name is None: return
+        del self.policies[policy_name]["selectors"][client_name]
+        self.dirty.add(policy_name)
+
+    def members(self, policy_name):
+        return set(self.policies[policy_name]["selectors"])
+
+    def token_name(self, policy_name):
+        # The policy's current token, tokens are rotated as {policy}-token-{n}
+        return self.token_names.get(policy_name, f"{policy_name}-token")
+
+    def token_name_pattern(self, policy_name):
+        return re.compile(f"^{re.escape(policy_name)}-token(-[0-9]+)?$")
+
+    def sync(self):
+        # Pushes every changed policy in one create/update/delete call each
+        for policy_name in sorted(self.dirty):
+            policy = self.policies[policy_name]
+            label_policies = [{"selector": selector} for selector in sorted(policy["selectors"].values())]
+            if not label_policies:
+                if policy["id"] is not None: self.cloud_api.delete_access_policy(policy["id"],policy["region"])
+                del self.policies[policy_name]
+                self.tokens.pop(policy_name, None)
+                self.token_names.pop(policy_name, None)
+                self.retired_tokens.pop(policy_name, None)    # deleting the policy deleted its tokens
+                continue
+            display_name = f"Access policy - {len(label_policies)} clients ({', '.join(policy['scopes'])})"
+            if policy["id"] is None:
+                response = self.cloud_api.create_access_policy(policy_name,display_name,label_policies,policy["region"],self.realm_identifier,self.realm_type,policy["scopes"])
+                policy["id"] = response["id"]
+            else:
+                self.cloud_api.update_access_policy(policy["id"],display_name,label_policies,policy["region"],self.realm_identifier,self.realm_type,policy["scopes"])
+        self.logger.info(f"Synced {len(self.dirty)} consolidated access policies")
+        self.dirty.clear()
+
+    def token_for(self, policy_name, expire_date=None):
+        # One token per policy per run, shared by every client stack in the policy. The new token is
+        # created next to the old ones, which keep working until retire_tokens() once every member
+        # datasource has been switched over.
+        if policy_name not in self.tokens:
+            policy = self.policies[policy_name]
+            name_pattern = self.token_name_pattern(policy_name)
+            existing_tokens = [token for token in self.cloud_api.get_access_policy_tokens(policy["region"])["items"] if name_pattern.match(token["name"])]
+            generation = max((int(token["name"].rsplit("-", 1)[1]) for token in existing_tokens if not token["name"].endswith("-token")), default=0) + 1
+            token_name = f"{policy_name}-token-{generation}"
+            display_name = f"Token for {policy_name}"
+            response = self.cloud_api.create_access_policy_token(token_name,display_name,policy["id"],policy["region"],expire_date)
+            self.tokens[policy_name] = response["token"]
+            self.token_names[policy_name] = token_name
+            self.retired_tokens.setdefault(policy_name, []).extend((token["id"], policy["region"]) for token in existing_tokens)
+        return self.tokens[policy_name]
+
+    def retire_tokens(self):
+        # Deletes the tokens replaced by token_for(), call once the member datasources use the new ones
+        for policy_name, tokens in self.retired_tokens.items():
+            for token_id, region in tokens: self.cloud_api.delete_access_policy_token(token_id,region)
+        self.retired_tokens.clear()
@@ -0,0 +1,295 @@
+import copy
+import logging
+import os
+from dataclasses import dataclass, field
+from typing import Optional
+import yaml
+
+DEFAULT_SCOPES = ("metrics:read", "logs:read", "traces:read")
+SECRET_KEYS = ("GRAFANA_CLOUD_TOKEN", "GRAFANA_TOKEN", "PROMETHEUS_TOKEN", "orgs")
+
+
+class ConfigError(ValueError):
+    pass
+
+
+def load_yml(file_path):
+    with open(file_path, 'r') as file:
+        return yaml.safe_load(file)
+
+
+def merge(base, overrides):
+    # Nested sections are merged key by key, everything else is replaced
+    merged = copy.deepcopy(base)
+    for key, value in overrides.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict): merged[key] = merge(merged[key], value)
+        else: merged[key] = copy.deepcopy(value)
+    return merged
+
+
+def check(section, raw, key, types, default=None, required=False):
+    if raw.get(key) is None:
+        if required: raise ConfigError(f"{section}{key} is required")
+        return default
+    value = raw[key]
+    # bool is an int subclass, don't let `true` pass as a number
+    if not isinstance(value, types) or (isinstance(value, bool) and bool not in (types if isinstance(types, tuple) else (types,))):
+        expected = " or ".join(t.__name__ for t in (types if isinstance(types, tuple) else (types,)))
+        raise ConfigError(f"{section}{key} must be {expected}, got {value!r}")
+    return value
+
+
+def check_keys(section, raw, allowed):
+    if not isinstance(raw, dict): raise ConfigError(f"{section or 'config'} must be a mapping, got {raw!r}")
+    unknown = set(raw) - set(allowed)
+    if unknown: raise ConfigError(f"Unknown {section or 'config '}keys: {', '.join(sorted(unknown))}")
+
+
+@dataclass(frozen=True)
+class MainStackConfig:
+    name: str
+    prometheus_datasource_uid: str = "grafanacloud-prom"
+    loki_datasource_uid: str = "grafanacloud-logs"
+    tempo_datasource_uid: str = "grafanacloud-traces"
+
+    @classmethod
+    def from_dict(cls, raw):
+        check_keys("main_stack.", raw, ("name", "prometheus_datasource_uid", "loki_datasource_uid", "tempo_datasource_uid"))
+        return cls(
+            name=check("main_stack.", raw, "name", str, required=True),
+            prometheus_datasource_uid=check("main_stack.", raw, "prometheus_datasource_uid", str, cls.prometheus_datasource_uid),
+            loki_datasource_uid=check("main_stack.", raw, "loki_datasource_uid", str, cls.loki_datasource_uid),
+            tempo_datasource_uid=check("main_stack.", raw, "tempo_datasource_uid", str, cls.tempo_datasource_uid),
+        )
+
+
+@dataclass(frozen=True)
+class DashboardsConfig:
+    folder_uid: Optional[str] = None
+    archive_path: str = "dashboards.tar.gz"
+    include_alert_rules: bool = True
+    max_workers: int = 8
+
+    @classmethod
+    def from_dict(cls, raw):
+        check_keys("dashboards.", raw, ("folder_uid", "archive_path", "include_alert_rules", "max_workers"))
+        return cls(
+            folder_uid=check("dashboards.", raw, "folder_uid", str),
+            archive_path=check("dashboards.", raw, "archive_path", str, cls.archive_path),
+            include_alert_rules=check("dashboards.", raw, "include_alert_rules", bool, cls.include_alert_rules),
+            max_workers=check("dashboards.", raw, "max_workers", int, cls.max_workers),
+        )
+
+
+@dataclass(frozen=True)
+class AccessPoliciesConfig:
+    consolidate: bool = False
+    max_selectors_per_policy: int = 10
+    scopes: tuple = DEFAULT_SCOPES
+
+    @classmethod
+    def from_dict(cls, raw):
+        check_keys("access_policies.", raw, ("consolidate", "max_selectors_per_policy", "scopes"))
+        max_selectors = check("access_policies.", raw, "max_selectors_per_policy", int, cls.max_selectors_per_policy)
+        if max_selectors < 1: raise ConfigError("access_policies.max_selectors_per_policy must be at least 1")
+        return cls(
+            consolidate=check("access_policies.", raw, "consolidate", bool, cls.consolidate),
+            max_selectors_per_policy=max_selectors,
+            scopes=tuple(check("access_policies.", raw, "scopes", list, list(DEFAULT_SCOPES))),
+        )
+
+
+@dataclass(frozen=True)
+class PollIntervals:
+    min_interval: float
+    max_interval: float
+
+    @classmethod
+    def from_dict(cls, section, raw, default):
+        check_keys(section, raw, ("min_interval", "max_interval"))
+        min_interval = check(section, raw, "min_interval", (int, float), default.min_interval)
+        max_interval = check(section, raw, "max_interval", (int, float), default.max_interval)
+        if not 0 < min_interval <= max_interval: raise ConfigError(f"{section}min_interval must be positive and no larger than max_interval")
+        return cls(min_interval, max_interval)
+
+
+@dataclass(frozen=True)
+class WatchConfig:
+    backoff: float = 2.0
+    token_renew_before_days: int = 30
+    stacks: PollIntervals = PollIntervals(30, 600)
+    tokens: PollIntervals = PollIntervals(300, 3600)
+    clients: PollIntervals = PollIntervals(60, 900)
+
+    @classmethod
+    def from_dict(cls, raw):
+        check_keys("watch.", raw, ("backoff", "token_renew_before_days", "stacks", "tokens", "clients"))
+        backoff = check("watch.", raw, "backoff", (int, float), cls.backoff)
+        if backoff < 1: raise ConfigError("watch.backoff must be at least 1")
+        return cls(
+            backoff=backoff,
+            token_renew_before_days=check("watch.", raw, "token_renew_before_days", int, cls.token_renew_before_days),
+            stacks=PollIntervals.from_dict("watch.stacks.", raw.get("stacks") or {}, cls.stacks),
+            tokens=PollIntervals.from_dict("watch.tokens.", raw.get("tokens") or {}, cls.tokens),
+            clients=PollIntervals.from_dict("watch.clients.", raw.get("clients") or {}, cls.clients),
+        )
+
+
+@dataclass(frozen=True)
+class ClientPlan:
+    # Everything create_stacks derives from a client name, computed once per client and config
+    name: str
+    slug: str
+    token_name: str
+    label_selector: str
+
+
+@dataclass(frozen=True)
+class Config:
+    log_level: str
+    log_file: str
+    org_slug: str
+    main_stack: MainStackConfig
+    token_valid_duration_days: int = 365
+    excludes: frozenset = frozenset()
+    region: Optional[str] = None
+    rate_limit_per_second: Optional[float] = None
+    max_shard_workers: Optional[int] = None
+    shards: tuple = ()
+    dashboards: Optional[DashboardsConfig] = None
+    access_policies: AccessPoliciesConfig = AccessPoliciesConfig()
+    watch: WatchConfig = WatchConfig()
+    raw: dict = field(default_factory=dict, repr=False, compare=False)
+    plans: dict = field(default_factory=dict, repr=False, compare=False)
+
+    @classmethod
+    def from_dict(cls, raw):
+        check_keys("", raw, ("log_level", "log_file", "org_slug", "main_stack", "token_valid_duration_days", "client_names_to_skip", "region", "rate_limit_per_second", "max_shard_workers", "shards", "dashboards", "access_policies", "watch"))
+        log_level = check("", raw, "log_level", str, "INFO").upper()
+        if not isinstance(logging.getLevelName(log_level), int): raise ConfigError(f"log_level {log_level!r} is not a logging level")
+        main_stack = check("", raw, "main_stack", dict, required=True)
+        shards = check("", raw, "shards", list, [])
+        for shard in shards:
+            if not isinstance(shard, dict): raise ConfigError(f"shards entries must be mappings, got {shard!r}")
+            if "shards" in shard: raise ConfigError("shards can not be nested")
+        excludes = check("", raw, "client_names_to_skip", list, [])
+        config = cls(
+            log_level=log_level,
+            log_file=check("", raw, "log_file", str, required=True),
+            org_slug=check("", raw, "org_slug", str, required=True),
+            main_stack=MainStackConfig.from_dict(main_stack),
+            token_valid_duration_days=check("", raw, "token_valid_duration_days", int, 365),
+            excludes=frozenset(str(name) for name in excludes),
+            region=check("", raw, "region", str),
+            rate_limit_per_second=check("", raw, "rate_limit_per_second", (int, float)),
+            max_shard_workers=check("", raw, "max_shard_workers", int),
+            shards=tuple(shards),
+            dashboards=DashboardsConfig.from_dict(raw["dashboards"]) if raw.get("dashboards") else None,
+            access_policies=AccessPoliciesConfig.from_dict(raw.get("access_policies") or {}),
+            watch=WatchConfig.from_dict(raw.get("watch") or {}),
+            raw=raw,
+        )
+        # Validate every shard now so a typo is reported on load, not when the shards start
+        config.shard_configs()
+        return config
+
+    def for_shard(self, overrides):
+        base = {k: v for k, v in self.raw.items() if k != "shards"}
+        return Config.from_dict(merge(base, overrides))
+
+    def shard_configs(self):
+        # Without a `shards` section the top level org and main stack form the only shard
+        if not self.shards: return [self]
+        configs = []
+        seen = {}
+        for index, shard in enumerate(self.shards, 1):
+            try: shard_config = self.for_shard(shard)
+            except ConfigError as e: raise ConfigError(f"shards entry {index}: {e}") from e
+            # Two shards on the same org and main stack would upsert the same stacks in parallel
+            key = (shard_config.org_slug, shard_config.main_stack.name)
+            if key in seen: raise ConfigError(f"shards entries {seen[key]} and {index} both manage org {key[0]} with main stack {key[1]}")
+            seen[key] = index
+            configs.append(shard_config)
+        return configs
+
+    def client_plan(self, client_name):
+        plan = self.plans.get(client_name)
+        if plan is None:
+            slug = f"{self.org_slug}-" + client_name.lower().replace(" ", "-")
+            plan = self.plans[client_name] = ClientPlan(
+                name=client_name,
+                slug=slug,
+                token_name=f"{slug}-token",
+                label_selector="{client_name=\"" + client_name + "\", client_environment=\"Production\"}",
+            )
+        return plan
+
+
+def known_secrets(section, raw):
+    # secrets.yml may hold keys for other tooling, unknown keys are reported and dropped rather than rejected
+    if not isinstance(raw, dict): raise ConfigError(f"{section or 'secrets'} must be a mapping, got {raw!r}")
+    unknown = set(raw) - set(SECRET_KEYS)
+    if unknown: logging.getLogger(__name__).warning(f"Ignoring unknown {section or 'secrets '}keys: {', '.join(sorted(unknown))}")
+    return {k: v for k, v in raw.items() if k in SECRET_KEYS}
+
+
+@dataclass(frozen=True)
+class Secrets:
+    grafana_cloud_token: str = field(repr=False)
+    grafana_token: str = field(repr=False)
+    prometheus_token: Optional[str] = field(default=None, repr=False)
+    orgs: dict = field(default_factory=dict, repr=False, compare=False)
+
+    @classmethod
+    def from_dict(cls, raw, section=""):
+        raw = known_secrets(section, raw)
+        orgs = check(section, raw, "orgs", dict, {})
+        secrets = cls(
+            grafana_cloud_token=check(section, raw, "GRAFANA_CLOUD_TOKEN", str, required=True),
+            grafana_token=check(section, raw, "GRAFANA_TOKEN", str, required=True),
+            prometheus_token=check(section, raw, "PROMETHEUS_TOKEN", str),
+            orgs={org_slug: merge({k: v for k, v in raw.items() if k != "orgs"}, known_secrets(f"orgs.{org_slug}.", org_secrets or {})) for org_slug, org_secrets in orgs.items()},
+        )
+        # Validate per-org overrides now rather than when a shard starts
+        for org_slug, org_secrets in secrets.orgs.items(): cls.from_dict(org_secrets, f"orgs.{org_slug}.")
+        return secrets
+
+    def for_org(self, org_slug):
+        return Secrets.from_dict(self.orgs[org_slug]) if org_slug in self.orgs else self
+
+
+class ConfigLoader:
+    # Loads and validates config.yml and secrets.yml. reload_if_changed() re-reads them when either
+    # file was modified; an invalid edit raises ConfigError and the previous config stays current.
+    def __init__(self, config_path, secrets_path, placeholder_secrets=None):
+        self.config_path = config_path
+        self.secrets_path = secrets_path
+        self.placeholder_secrets = placeholder_secrets
+        self.config = None
+        self.secrets = None
+        self.mtimes = None
+
+    def file_mtimes(self):
+        return tuple(os.stat(path).st_mtime_ns if os.path.exists(path) else None for path in (self.config_path, self.secrets_path))
+
+    def read(self):
+        try:
+            config = Config.from_dict(load_yml(self.config_path) or {})
+            if self.placeholder_secrets is not None and not os.path.exists(self.secrets_path): secrets = self.placeholder_secrets
+            else: secrets = Secrets.from_dict(load_yml(self.secrets_path) or {})
+        except (OSError, yaml.YAMLError) as e:
+            raise ConfigError(f"Could not read config: {e}") from e
+        return config, secrets
+
+    def load(self):
+        self.mtimes = self.file_mtimes()
+        self.config, self.secrets = self.read()
+        return self.config, self.secrets
+
+    def reload_if_changed(self):
+        mtimes = self.file_mtimes()
+        if mtimes == self.mtimes: return False
+        # Remember the new mtimes first so a broken edit is reported once, not on every poll
+        self.mtimes = mtimes
+        self.config, self.secrets = self.read()
+        return True
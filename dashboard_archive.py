@@ -0,0 +1,144 @@
+import tarfile
+import json
+import io
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# Archive layout. Members are written in this order so that a streaming reader always
+# sees a folder before anything that lives in it.
+FOLDERS_DIR = "folders"
+DASHBOARDS_DIR = "dashboards"
+ALERT_RULES_DIR = "alert-rules"
+
+
+def add_json_member(archive, name, content):
+    data = json.dumps(content).encode()
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = int(time.time())
+    archive.addfile(info, io.BytesIO(data))
+
+
+def iter_dashboards(api, folder_uids=None, page_size=1000):
+    page = 1
+    while True:
+        results = api.search_dashboards(folder_uids=folder_uids, limit=page_size, page=page)
+        yield from results
+        if len(results) < page_size: return
+        page += 1
+
+
+def export_folder_tree(api, archive_path, folder_uid=None, include_alert_rules=True, logger=None):
+    # Streams folders, dashboards and alert rules under folder_uid (or the whole stack) into a
+    # gzipped tar archive. Each object is fetched, written and dropped before the next one,
+    # so memory stays flat no matter how many dashboards the stack has.
+    logger = logger if logger is not None else api.logger
+    logger.info(f"Exporting folder tree {folder_uid if folder_uid else 'root'} to {archive_path}")
+    counts = {"folders": 0, "dashboards": 0, "alert_rules": 0}
+    with tarfile.open(archive_path, "w|gz") as archive:
+        folders = api.get_folder_tree(folder_uid)
+        folder_uids = [folder["uid"] for folder in folders]
+        for folder in folders:
+            # Only basic role permissions are portable, user and team ids differ between stacks
+            permissions = [{"role": item["role"], "permission": item["permission"]} for item in api.get_folder_permisions(folder["uid"]) if item.get("role")]
+            content = {
+                "uid": folder["uid"],
+                "title": folder["title"],
+                "parentUid": None if folder["uid"] == folder_uid else folder.get("parentUid"),
+                "permissions": permissions
+            }
+            add_json_member(archive, f"{FOLDERS_DIR}/{folder['uid']}.json", content)
+            counts["folders"] += 1
+
+        for result in iter_dashboards(api, folder_uids if folder_uid else None):
+            dashboard = api.get_dashboard(result["uid"])
+            content = {
+                "dashboard": dashboard["dashboard"],
+                "folderUid": dashboard.get("meta", {}).get("folderUid") or None
+            }
+            add_json_member(archive, f"{DASHBOARDS_DIR}/{result['uid']}.json", content)
+            counts["dashboards"] += 1
+
+        if include_alert_rules:
+            for rule in api.get_alert_rules():
+                if folder_uid and rule.get("folderUID") not in folder_uids: continue
+                add_json_member(archive, f"{ALERT_RULES_DIR}/{rule['uid']}.json", rule)
+                counts["alert_rules"] += 1
+    logger.info(f"Exported {counts} to {archive_path}")
+    return counts
+
+
+def remap_datasource_uids(content, datasource_uid_map):
+    # Returns a copy of a dashboard or alert rule with every datasource reference found in
+    # datasource_uid_map pointed at its new uid. The input is never modified, so one parsed
+    # object can be remapped for several stacks.
+    if not datasource_uid_map: return content
+    if isinstance(content, list): return [remap_datasource_uids(item, datasource_uid_map) for item in content]
+    if not isinstance(content, dict): return content
+    remapped = {}
+    for key, value in content.items():
+        if key == "datasource" and isinstance(value, dict) and value.get("uid") in datasource_uid_map:
+            remapped[key] = {**value, "uid": datasource_uid_map[value["uid"]]}
+        elif key in ("datasource", "datasourceUid") and isinstance(value, str) and value in datasource_uid_map:
+            remapped[key] = datasource_uid_map[value]
+        else:
+            remapped[key] = remap_datasource_uids(value, datasource_uid_map)
+    return remapped
+
+
+def import_folder(api, folder):
+    api.ensure_folder(folder["title"], folder["uid"], folder.get("parentUid"))
+    if folder.get("permissions"): api.update_folder_permissions(folder["uid"], folder["permissions"])
+
+
+def import_dashboard(api, content, datasource_uid_map):
+    dashboard = remap_datasource_uids(content["dashboard"], datasource_uid_map)
+    return api.upsert_dashboard(dashboard, folder_uid=content.get("folderUid"), message="Imported by stack manager")
+
+
+def import_alert_rule(api, rule, datasource_uid_map):
+    return api.upsert_alert_rule(remap_datasource_uids(rule, datasource_uid_map))
+
+
+def import_archive(archive_path, targets, max_workers=8, max_pending=None, logger=None):
+    # Streams an archive written by export_folder_tree into every target stack in parallel.
+    # targets is a list of (GrafanaApi, datasource_uid_map) tuples. Folders are applied to all
+    # targets before the reader moves on, dashboards and alert rules are fanned out with at most
+    # max_pending uploads queued so the archive is never fully held in memory.
+    max_pending = max_pending if max_pending is not None else max_workers * 4
+    results = {api.grafana_root_url: {"folders": 0, "dashboards": 0, "alert_rules": 0, "errors": []} for api, _ in targets}
+    pending = {}
+
+    def collect(done):
+        for future in done:
+            url, kind, uid = pending.pop(future)
+            try:
+                future.result()
+                results[url][kind] += 1
+            except (Exception, SystemExit) as e:
+                results[url]["errors"].append({"kind": kind, "uid": uid, "error": repr(e)})
+                if logger: logger.error(f"Failed to import {kind} {uid} into {url}: {e!r}")
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor, tarfile.open(archive_path, "r|gz") as archive:
+        for member in archive:
+            if not member.isfile(): continue
+            kind_dir, _, file_name = member.name.partition("/")
+            content = json.load(archive.extractfile(member))
+            uid = file_name.removesuffix(".json")
+            for api, datasource_uid_map in targets:
+                if kind_dir == FOLDERS_DIR: future, kind = executor.submit(import_folder, api, content), "folders"
+                elif kind_dir == DASHBOARDS_DIR: future, kind = executor.submit(import_dashboard, api, content, datasource_uid_map), "dashboards"
+                elif kind_dir == ALERT_RULES_DIR: future, kind = executor.submit(import_alert_rule, api, content, datasource_uid_map), "alert_rules"
+                else: continue
+                pending[future] = (api.grafana_root_url, kind, uid)
+            if kind_dir == FOLDERS_DIR:
+                # Children must not be created before their parent exists in every target
+                collect(wait(list(pending)).done)
+            while len(pending) >= max_pending:
+                collect(wait(list(pending), return_when=FIRST_COMPLETED).done)
+        collect(wait(list(pending)).done)
+
+    if logger:
+        for url, result in results.items():
+            logger.info(f"Imported {result['folders']} folders, {result['dashboards']} dashboards and {result['alert_rules']} alert rules into {url} with {len(result['errors'])} errors")
+    return results
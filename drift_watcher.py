@@ -0,0 +1,156 @@
+import datetime
+import threading
+import time
+
+
+class PollSource:
+    # A cheap summary that is polled on its own adaptive interval. The interval drops back to
+    # min_interval whenever something changed and grows by `backoff` on every quiet poll, up to
+    # max_interval. detect(previous, current) returns the client names that need reconciling.
+    def __init__(self, name, fetch, detect, min_interval, max_interval, backoff=2.0):
+        self.name = name
+        self.fetch = fetch
+        self.detect = detect
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.interval = min_interval
+        self.next_poll_at = 0
+        self.summary = None
+
+    def poll(self, now):
+        current = self.fetch()
+        affected = self.detect(self.summary, current)
+        changed = bool(affected) or (self.summary is not None and current != self.summary)
+        self.summary = current
+        self.interval = self.min_interval if changed else min(self.interval * self.backoff, self.max_interval)
+        self.next_poll_at = now + self.interval
+        return affected
+
+    def poll_soon(self, now):
+        self.interval = self.min_interval
+        self.next_poll_at = min(self.next_poll_at, now + self.min_interval)
+
+
+class DriftWatcher:
+    def __init__(self, stack_manager, watch_config=None, config_loader=None):
+        self.stack_manager = stack_manager
+        self.logger = stack_manager.logger
+        self.config_loader = config_loader
+        self.sources = [
+            PollSource("stacks", self.fetch_stacks, self.detect_stack_drift, 0, 0),
+            PollSource("tokens", self.fetch_tokens, self.detect_token_drift, 0, 0),
+            PollSource("clients", self.fetch_clients, self.detect_client_changes, 0, 0),
+        ]
+        self.configure(watch_config if watch_config is not None else stack_manager.config.watch)
+        self.pending_clients = set()
+        self.stopped = threading.Event()
+
+    def configure(self, watch_config):
+        # Also used on config reload, sources keep their last summary so no change is lost
+        self.token_renew_before = datetime.timedelta(days=watch_config.token_renew_before_days)
+        for source in self.sources:
+            intervals = getattr(watch_config, source.name)
+            source.min_interval = intervals.min_interval
+            source.max_interval = intervals.max_interval
+            source.backoff = watch_config.backoff
+            source.interval = min(max(source.interval, source.min_interval), source.max_interval)
+
+    # ------------------------------------------------
+    # Summaries
+    def fetch_stacks(self):
+        stacks = self.stack_manager.cloud_api.get_stacks()
+        return {stack["name"]: (stack["slug"], stack.get("url")) for stack in stacks["items"]}
+
+    def fetch_tokens(self):
+        tokens = self.stack_manager.cloud_api.get_access_policy_tokens(self.stack_manager.policy_region)
+        return {token["name"]: token.get("expiresAt") for token in tokens["items"]}
+
+    def fetch_clients(self):
+        main_stacks = {"items": [self.stack_manager.main_stack]}
+        return self.stack_manager.get_clients_from_prometheus(main_stacks, self.stack_manager.main_stack_name)
+
+    # ------------------------------------------------
+    # Change detection
+    def detect_stack_drift(self, previous, current):
+        targets = self.stack_manager.get_target_clients()
+        affected = {client for client in targets if client not in current}
+        if previous is not None: affected |= {client for client in targets if client in previous and previous[client] != current.get(client)}
+        return affected
+
+    def detect_token_drift(self, previous, current):
+        renew_before = datetime.datetime.now(datetime.timezone.utc) + self.token_renew_before
+        affected = set()
+        for client in self.stack_manager.get_target_clients():
+            expires_at = current.get(self.stack_manager.client_token_name(client), "missing")
+            if expires_at == "missing": affected.add(client)
+            elif expires_at is not None and parse_timestamp(expires_at) < renew_before: affected.add(client)
+        return affected
+
+    def detect_client_changes(self, previous, current):
+        # Labels are refreshed on every poll, only new or relabelled clients are reconciled
+        self.stack_manager.client_info = current
+        if previous is None: return set()
+        return {client["client_name"] for key, client in current.items() if previous.get(key) != client}
+
+    # ------------------------------------------------
+    # Loop
+    def reload_config(self):
+        try:
+            if not self.config_loader.reload_if_changed(): return
+        except Exception as e:
+            self.logger.error(f"Config reload failed, keeping the running config: {e}")
+            return
+        previous_targets = self.stack_manager.get_target_clients()
+        if not self.stack_manager.apply_config(self.config_loader.config, self.config_loader.secrets): return
+        self.configure(self.stack_manager.config.watch)
+        # Clients that are no longer excluded get provisioned straight away
+        added = self.stack_manager.get_target_clients() - previous_targets
+        if added: self.logger.info(f"Config reload added clients {sorted(added)}")
+        self.pending_clients |= added
+
+    def run_once(self, now=None):
+        now = now if now is not None else time.monotonic()
+        if self.config_loader is not None: self.reload_config()
+        for source in self.sources:
+            if now < source.next_poll_at: continue
+            try:
+                affected = source.poll(now)
+            except (Exception, SystemExit) as e:
+                # Keep the previous summary and try again after the current interval
+                self.logger.error(f"Polling {source.name} failed: {e!r}")
+                source.next_poll_at = now + source.interval
+                continue
+            if affected: self.logger.info(f"Drift in {source.name} for {sorted(affected)}")
+            self.pending_clients |= affected
+        self.pending_clients &= self.stack_manager.get_target_clients()
+        if self.pending_clients: self.reconcile(now)
+
+    def reconcile(self, now):
+        clients = set(self.pending_clients)
+        self.logger.info(f"Reconciling {len(clients)} clients")
+        try:
+            self.stack_manager.create_stacks(clients=clients)
+        except (Exception, SystemExit) as e:
+            self.logger.error(f"Reconciling {sorted(clients)} failed, will retry: {e!r}")
+            return
+        self.pending_clients -= clients
+        # Confirm the fix quickly instead of waiting out a backed off interval
+        for source in self.sources: source.poll_soon(now)
+
+    def run(self):
+        self.stopped.clear()
+        self.logger.info("Watching for drift")
+        while not self.stopped.is_set():
+            self.run_once()
+            next_poll_at = min(source.next_poll_at for source in self.sources)
+            self.stopped.wait(max(0, next_poll_at - time.monotonic()))
+        self.logger.info("Stopped watching for drift")
+
+    def stop(self, *args):
+        self.stopped.set()
+
+
+def parse_timestamp(value):
+    timestamp = datetime.datetime.fromisoformat(value.replace("Z", "+00:00"))
+    return timestamp if timestamp.tzinfo else timestamp.replace(tzinfo=datetime.timezone.utc)
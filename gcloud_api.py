@@ -1,4 +1,6 @@
 import requests
+import asyncio
+from single_flight import SingleFlight, request_key, write_scope
 import json
 import time
 import datetime
@@ -8,16 +10,46 @@ import sys
 
 class GrafanaCloudApi:
     
-    def __init__(self, token, logger, org_slug=None,grafna_root_url = "https://grafana.com"):
+    def __init__(self, token, logger, org_slug=None,grafna_root_url = "https://grafana.com",region="us",rate_limiter=None,transport=None,single_flight=None):
         self.token = token
         self.org_slug = org_slug
+        self.region = region
         self.grafana_root_url = grafna_root_url
         self.logger = logger
+        self.rate_limiter = rate_limiter
+        self.transport = transport
+        self.single_flight = single_flight if single_flight is not None else SingleFlight()
+        self.session = requests.Session()
         self.headers = {
             'Content-Type': 'application/json',
             'Authorization': f'Bearer {self.token}'
         }
     
+    def request(self, method, url, **kwargs):
+        # Every call goes through here so it shares the session's connection pool, the rate limit
+        # and the transport used to record or replay a run. Identical GETs already in flight are
+        # coalesced into one request.
+        kwargs.setdefault("headers", self.headers)
+        if method == "GET":
+            key = request_key(method, url, kwargs.get("params"), kwargs["headers"], self.single_flight.writes(write_scope(self.grafana_root_url, kwargs["headers"])))
+            return self.single_flight.do(key, lambda: self.send(method, url, **kwargs))
+        return self.send(method, url, **kwargs)
+
+    def send(self, method, url, **kwargs):
+        if method != "GET": self.single_flight.record_write(write_scope(self.grafana_root_url, kwargs.get("headers")))
+        if self.rate_limiter is not None: self.rate_limiter.acquire()
+        if self.transport is not None: return self.transport.send(self.session, method, url, **kwargs)
+        return self.session.request(method, url, **kwargs)
+
+    async def request_async(self, method, url, **kwargs):
+        # For asyncio callers, the blocking send runs in the default executor. GETs share in-flight
+        # calls with threaded callers of request().
+        kwargs.setdefault("headers", self.headers)
+        if method == "GET":
+            key = request_key(method, url, kwargs.get("params"), kwargs["headers"], self.single_flight.writes(write_scope(self.grafana_root_url, kwargs["headers"])))
+            return await self.single_flight.do_async(key, lambda: self.send(method, url, **kwargs))
+        return await asyncio.get_running_loop().run_in_executor(None, lambda: self.send(method, url, **kwargs))
+
 
     def handle_response(self, response,success_codes=[200,201,204]):
         response.raise_for_status()
@@ -38,15 +70,25 @@ class GrafanaCloudApi:
         org_slug = org_slug if org_slug is not None else self.org_slug
         self.logger.info(f"Getting stacks for org {org_slug}")
         url = f'{self.grafana_root_url}/api/orgs/{org_slug}/instances'
-        response = self.handle_response(requests.get(url, headers=self.headers),success_codes)
+        response = self.handle_response(self.request("GET", url),success_codes)
         stack_names = [stack["name"] for stack in response["items"]]
         self.logger.debug(f"Found {len(response['items'])} stacks. {stack_names}")
         return response
+
+    async def get_stacks_async(self,org_slug=None):
+        success_codes = [200]
+        org_slug = org_slug if org_slug is not None else self.org_slug
+        self.logger.info(f"Getting stacks for org {org_slug}")
+        url = f'{self.grafana_root_url}/api/orgs/{org_slug}/instances'
+        response = self.handle_response(await self.request_async("GET", url),success_codes)
+        self.logger.debug(f"Found {len(response['items'])} stacks")
+        return response
     
-    def create_stack(self,name,slug,url=None,description=None,labels=None,region="us"):
+    def create_stack(self,name,slug,url=None,description=None,labels=None,region=None):
         # https://grafana.com/docs/grafana-cloud/developer-resources/api-reference/cloud-api/#create-stack
         # TODO: do something with the response codes
         success_codes = [200]
+        region = region if region is not None else self.region
         body = {
             "name": name,
             "slug": slug,
@@ -58,7 +100,7 @@ class GrafanaCloudApi:
         # POST https://grafana.com/api/instances
         url = f'{self.grafana_root_url}/api/instances'
         self.logger.info(f"Creating stack {name}")
-        response = self.handle_response(requests.post(url, headers=self.headers, data=json.dumps(body)),success_codes)
+        response = self.handle_response(self.request("POST", url, data=json.dumps(body)),success_codes)
         self.logger.debug(f"Created stack {name} {response}")
         return response
 
@@ -72,7 +114,7 @@ class GrafanaCloudApi:
         }.items() if v is not None}
         url = f'{self.grafana_root_url}/api/instances/{stack_id_or_slug}'
         self.logger.info(f"Updating stack {stack_id_or_slug}")
-        response = self.handle_response(requests.post(url, headers=self.headers, data=json.dumps(body)),success_codes)
+        response = self.handle_response(self.request("POST", url, data=json.dumps(body)),success_codes)
         self.logger.debug(f"Updated stack {stack_id_or_slug} {response}")
         return response 
 
@@ -81,11 +123,11 @@ class GrafanaCloudApi:
         success_codes = [200]
         url = f'{self.grafana_root_url}/api/instances/{stack_id}'
         self.logger.info(f"Deleting stack {stack_id}")
-        response = self.handle_response(requests.delete(url, headers=self.headers),success_codes)
+        response = self.handle_response(self.request("DELETE", url),success_codes)
         self.logger.debug(f"Deleted stack {stack_id}")
         return response
     
-    def upsert_stack(self,name,slug,url=None,region="us",description=None,labels=None):
+    def upsert_stack(self,name,slug,url=None,region=None,description=None,labels=None):
         # Method 
         self.logger.info(f"Syncing stack {name}")
         existing_stacks = self.get_stacks()                                                                                          # get all stacks
@@ -98,7 +140,7 @@ class GrafanaCloudApi:
             "labels": labels
         }.items() if v is not None }
         existing_stack = next((stack for stack in existing_stacks["items"] if stack["name"] == name), None)                     # find existing stack   
-        if existing_stack is None:  new_stack = self.create_stack(name,slug,url,region,description,labels)                  # create new stack if not found
+        if existing_stack is None:  new_stack = self.create_stack(name,slug,url,description=description,labels=labels,region=region)  # create new stack if not found
         else: self.update_stack(existing_stack["id"],name,description,labels)                                                      # update existing stack
         existing_stacks = self.get_stacks()                                                                                         # get all stacks                                    
         new_stack = next((stack for stack in existing_stacks["items"] if stack["name"] == name), None)                        # find new stack
@@ -108,7 +150,7 @@ class GrafanaCloudApi:
         # https://grafana.com/docs/grafana-cloud/developer-resources/api-reference/cloud-api/#restart-grafana
         url = f'{self.grafana_root_url}/api/instances/{stack_slug}/restart'
         self.logger.info(f"Restarting stack {stack_slug}")
-        response = self.handle_response(requests.post(url, headers=self.headers))
+        response = self.handle_response(self.request("POST", url))
         self.logger.debug(f"Restarted stack {stack_slug}")
         return response
 
@@ -122,7 +164,7 @@ class GrafanaCloudApi:
     #         "role": role,
     #     }
     #     if secondsToLive is not None: body["secondsToLive"] = secondsToLive
-    #     response = self.handle_response(requests.post(url, headers=self.headers, data=json.dumps(body)),success_codes)
+    #     response = self.handle_response(self.request("POST", url, data=json.dumps(body)),success_codes)
     #     self.logger.debug(f"Created stack api key for stack {stack_slug}")
     #     return response
 
@@ -131,16 +173,17 @@ class GrafanaCloudApi:
         url = f'{self.grafana_root_url}/api/instances/{stack_slug}/datasources'
         success_codes = [200]
         self.logger.info(f"Listing datasources for stack {stack_slug}")
-        response = self.handle_response(requests.get(url, headers=self.headers),success_codes)
+        response = self.handle_response(self.request("GET", url),success_codes)
         self.logger.debug(f"Found {len(response['items'])} datasources for stack {stack_slug}")
         return response
 
     #------------------------------------------------
     # Access Policies
-    def get_access_policies(self,name=None,realmType=None,realmIdentifier=None,pageSize=None,pageCursor=None,region='us',status=None):
+    def get_access_policies(self,name=None,realmType=None,realmIdentifier=None,pageSize=None,pageCursor=None,region=None,status=None):
         # https://grafana.com/docs/grafana-cloud/developer-resources/api-reference/cloud-api/#list-access-policies
         success_codes = [200]
         self.logger.info(f"Getting access policies")
+        region = region if region is not None else self.region
         url = f'{self.grafana_root_url}/api/v1/accesspolicies'
         params = {k: v for k, v in {
                 'name': name,
@@ -151,17 +194,17 @@ class GrafanaCloudApi:
                 'region': region,
                 'status': status
             }.items() if v is not None}
-        response = self.handle_response(requests.get(url, headers=self.headers, params=params),success_codes)
+        response = self.handle_response(self.request("GET", url, params=params),success_codes)
         self.logger.debug(f"Found {len(response['items'])} access policies")
         return response
     
     def get_access_policy(self,access_policy_id,region=None):
         # https://grafana.com/docs/grafana-cloud/developer-resources/api-reference/cloud-api/#list-one-access-policy
         success_codes = [200]
-        params = {'region': region}
+        params = {'region': region if region is not None else self.region}
         self.logger.info(f"Getting access policy {access_policy_id}")
         url = f'{self.grafana_root_url}/api/v1/accesspolicies/{access_policy_id}'
-        response = self.handle_response(requests.get(url, headers=self.headers, params=params),success_codes)
+        response = self.handle_response(self.request("GET", url, params=params),success_codes)
         self.logger.debug(f"Found access policy {access_policy_id} {response}")
         return response
 
@@ -184,7 +227,7 @@ class GrafanaCloudApi:
         # data["conditions"] = conditions
          
         params = {'region': region}
-        response = self.handle_response(requests.post(url, headers=self.headers, params=params, data=json.dumps(data)),success_codes)
+        response = self.handle_response(self.request("POST", url, params=params, data=json.dumps(data)),success_codes)
         self.logger.debug(f"Created access policy {policy_name} {response}")
         return response
     
@@ -205,7 +248,7 @@ class GrafanaCloudApi:
         # data["conditions"] = conditions
 
         params = {'region': region}
-        response = self.handle_response(requests.post(url, headers=self.headers, params=params, data=json.dumps(data)),success_codes)
+        response = self.handle_response(self.request("POST", url, params=params, data=json.dumps(data)),success_codes)
         self.logger.debug(f"Updated access policy {access_policy_id}")
         return response
     
@@ -215,7 +258,7 @@ class GrafanaCloudApi:
         success_codes = [204]
         params = {'region': region}
         url = f'{self.grafana_root_url}/api/v1/accesspolicies/{access_policy_id}'
-        response = self.handle_response(requests.delete(url, headers=self.headers, params=params),success_codes)
+        response = self.handle_response(self.request("DELETE", url, params=params),success_codes)
         self.logger.debug(f"Deleted access policy {access_policy_id}")
         return response
 
@@ -243,15 +286,26 @@ class GrafanaCloudApi:
          
 
     # Access Policy Tokens
-    def get_access_policy_tokens(self,region='us',access_policy_id=None,access_policy_name=None,access_policy_realm_type=None,access_policy_realm_identifier=None,name=None,expiresBefore=None,expiresAfter=None,pageSize=None,pageCursor=None,access_policy_status=None):
-        # https://grafana.com/docs/grafana-cloud/developer-resources/api-reference/cloud-api/#list-a-set-of-tokens
-        self.logger.info(f"Getting access policy tokens for access policy {access_policy_id}")
-        params = { k : v for k, v in {
+    def access_policy_token_params(self,region=None,access_policy_name=None,access_policy_realm_type=None,access_policy_realm_identifier=None,name=None,expiresBefore=None,expiresAfter=None,pageSize=None,pageCursor=None,access_policy_status=None):
+        region = region if region is not None else self.region
+        return { k : v for k, v in {
         'region': region,'accessPolicyName': access_policy_name, 'accessPolicyRealmType': access_policy_realm_type, 'accessPolicyRealmIdentifier': access_policy_realm_identifier, 'name': name, 'expiresBefore': expiresBefore, 'expiresAfter': expiresAfter, 'pageSize': pageSize, 'pageCursor': pageCursor, 'status': access_policy_status
         }.items() if v is not None}
 
+    def get_access_policy_tokens(self,region=None,access_policy_id=None,access_policy_name=None,access_policy_realm_type=None,access_policy_realm_identifier=None,name=None,expiresBefore=None,expiresAfter=None,pageSize=None,pageCursor=None,access_policy_status=None):
+        # https://grafana.com/docs/grafana-cloud/developer-resources/api-reference/cloud-api/#list-a-set-of-tokens
+        self.logger.info(f"Getting access policy tokens for access policy {access_policy_id}")
+        params = self.access_policy_token_params(region,access_policy_name,access_policy_realm_type,access_policy_realm_identifier,name,expiresBefore,expiresAfter,pageSize,pageCursor,access_policy_status)
+        url = f'{self.grafana_root_url}/api/v1/tokens'
+        response = self.handle_response(self.request("GET", url, params=params))
+        self.logger.debug(f"Found {len(response['items'])} access policy tokens")
+        return response
+
+    async def get_access_policy_tokens_async(self,region=None,access_policy_id=None,access_policy_name=None,access_policy_realm_type=None,access_policy_realm_identifier=None,name=None,expiresBefore=None,expiresAfter=None,pageSize=None,pageCursor=None,access_policy_status=None):
+        self.logger.info(f"Getting access policy tokens for access policy {access_policy_id}")
+        params = self.access_policy_token_params(region,access_policy_name,access_policy_realm_type,access_policy_realm_identifier,name,expiresBefore,expiresAfter,pageSize,pageCursor,access_policy_status)
         url = f'{self.grafana_root_url}/api/v1/tokens'
-        response = self.handle_response(requests.get(url, headers=self.headers, params=params))
+        response = self.handle_response(await self.request_async("GET", url, params=params))
         self.logger.debug(f"Found {len(response['items'])} access policy tokens")
         return response
     
@@ -260,7 +314,7 @@ class GrafanaCloudApi:
         self.logger.info(f"Getting access policy token {token_id}")
         url = f'{self.grafana_root_url}/api/v1/tokens/{token_id}'
         params = {'region': region}
-        response = self.handle_response(requests.get(url, headers=self.headers, params=params))
+        response = self.handle_response(self.request("GET", url, params=params))
         self.logger.debug(f"Found access policy token {token_id} {response}")
         return response
     
@@ -272,7 +326,7 @@ class GrafanaCloudApi:
         data = {
             "display_name": new_name
         }
-        response = self.handle_response(requests.post(url, headers=self.headers, params=params, data=json.dumps(data)))
+        response = self.handle_response(self.request("POST", url, params=params, data=json.dumps(data)))
         self.logger.debug(f"Updated access policy token {token_id} {response}")
         return response
 
@@ -282,7 +336,7 @@ class GrafanaCloudApi:
         self.logger.info(f"Deleting access policy token {token_id}")
         url = f'{self.grafana_root_url}/api/v1/tokens/{token_id}'
         params = {'region': region}
-        response = self.handle_response(requests.delete(url, headers=self.headers, params=params),success_codes)
+        response = self.handle_response(self.request("DELETE", url, params=params),success_codes)
         self.logger.debug(f"Deleted access policy token {token_id}")
         return response
 
@@ -297,7 +351,7 @@ class GrafanaCloudApi:
             "accessPolicyId": access_policy_id,
             "expiresAt": expire_date.isoformat() if expire_date is not None else None
         }.items() if v is not None}
-        response = self.handle_response(requests.post(url, headers=self.headers, params=params, data=json.dumps(data)))
+        response = self.handle_response(self.request("POST", url, params=params, data=json.dumps(data)))
         self.logger.debug(f"Created access policy token {name} {response}")
         return response
 
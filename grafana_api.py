@@ -1,18 +1,47 @@
 import requests
+import asyncio
+from single_flight import SingleFlight, request_key, write_scope
 import json
 import sys
 
 
 class GrafanaApi:
-    def __init__(self, token,grafana_root_url,logger):
+    def __init__(self, token,grafana_root_url,logger,rate_limiter=None,transport=None,single_flight=None):
         # 
         self.token = token
         self.logger = logger
         self.grafana_root_url = grafana_root_url
+        self.rate_limiter = rate_limiter
+        self.transport = transport
+        self.single_flight = single_flight if single_flight is not None else SingleFlight()
+        self.session = requests.Session()
         self.headers = {
             'Content-Type': 'application/json',
             'Authorization': f'Bearer {self.token}'
         }
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("headers", self.headers)
+        if method == "GET":
+            key = request_key(method, url, kwargs.get("params"), kwargs["headers"], self.single_flight.writes(write_scope(self.grafana_root_url, kwargs["headers"])))
+            return self.single_flight.do(key, lambda: self.send(method, url, **kwargs))
+        return self.send(method, url, **kwargs)
+
+    def send(self, method, url, **kwargs):
+        if method != "GET": self.single_flight.record_write(write_scope(self.grafana_root_url, kwargs.get("headers")))
+        if self.rate_limiter is not None: self.rate_limiter.acquire()
+        if self.transport is not None: return self.transport.send(self.session, method, url, **kwargs)
+        return self.session.request(method, url, **kwargs)
+
+    async def request_async(self, method, url, **kwargs):
+        # For asyncio callers, the blocking send runs in the default executor. GETs share in-flight
+        # calls with threaded callers of request().
+        kwargs.setdefault("headers", self.headers)
+        if method == "GET":
+            key = request_key(method, url, kwargs.get("params"), kwargs["headers"], self.single_flight.writes(write_scope(self.grafana_root_url, kwargs["headers"])))
+            return await self.single_flight.do_async(key, lambda: self.send(method, url, **kwargs))
+        return await asyncio.get_running_loop().run_in_executor(None, lambda: self.send(method, url, **kwargs))
+
     def handle_response(self, response):
         success_codes = [200,201,204]
         if response.status_code not in success_codes:
@@ -30,7 +59,7 @@ class GrafanaApi:
         # https://grafana.com/docs/grafana-cloud/developer-resources/api-reference/http-api/access_control/#get-all-roles
         self.logger.info(f"Getting roles")
         url = f'{self.grafana_root_url}/api/access-control/roles'
-        response = self.handle_response(requests.get(url, headers=self.headers))
+        response = self.handle_response(self.request("GET", url))
         self.logger.debug(f"Found {len(response)} roles")
         return response
     
@@ -38,7 +67,7 @@ class GrafanaApi:
         # https://grafana.com/docs/grafana-cloud/developer-resources/api-reference/http-api/access_control/#get-a-custom-role
         self.logger.info(f"Getting role {role_uid}")
         url = f'{self.grafana_root_url}/api/access-control/roles/{role_uid}'
-        response = self.handle_response(requests.get(url, headers=self.headers))
+        response = self.handle_response(self.request("GET", url))
         self.logger.debug(f"Got role {role_uid}\n{response}")
         return response
 
@@ -55,7 +84,7 @@ class GrafanaApi:
             "permissions": permissions
 
         }
-        try: response = self.handle_response(requests.post(url, headers=self.headers, data=json.dumps(data)))
+        try: response = self.handle_response(self.request("POST", url, data=json.dumps(data)))
         except: response = self.get_role(uid)
         self.logger.debug(f"Created role {name} {response}")
         return response
@@ -64,35 +93,38 @@ class GrafanaApi:
         # https://grafana.com/docs/grafana-cloud/developer-resources/api-reference/http-api/access_control/#delete-a-custom-role
         self.logger.info(f"Deleting role {role_uid}")
         url = f'{self.grafana_root_url}/api/access-control/roles/{role_uid}'
-        response = self.handle_response(requests.delete(url, headers=self.headers, params=params))
+        response = self.handle_response(self.request("DELETE", url, params=params))
         self.logger.debug(f"Deleted role {role_uid}")
         return response
     
 
     ############################################################
     # Folders
-    def get_folders(self):
+    def get_folders(self,parent_folder_uid=None):
         url = f"{self.grafana_root_url}/api/folders"
-        response = self.handle_response(requests.get(url, headers=self.headers))
+        params = {'parentUid': parent_folder_uid} if parent_folder_uid is not None else None
+        response = self.handle_response(self.request("GET", url, params=params))
         return response
 
     def get_folder(self,folder_uid,handle=True):
         self.logger.debug(f"Getting folder {folder_uid}")
         url = f"{self.grafana_root_url}/api/folders/{folder_uid}"
-        response = requests.get(url, headers=self.headers)
+        response = self.request("GET", url)
         if handle: response = self.handle_response(response)
         self.logger.debug(f"Got folder {folder_uid}")
         return response
 
-    def create_folder(self,folder_title,folder_uid,parent_folder_uid=None,org_id=1):
-        try: folder_exists = True if self.get_folder(folder_uid,handle=False) else False
-        except: folder_exists = False
+    def create_folder(self,folder_title,folder_uid,parent_folder_uid=None,org_id=1,check_exists=True):
+        folder_exists = False
+        if check_exists:
+            try: folder_exists = True if self.get_folder(folder_uid,handle=False) else False
+            except: folder_exists = False
         
         if not folder_exists:    
             self.logger.debug("Creating folder")
             url = f"{self.grafana_root_url}/api/folders"
             data = {"title": folder_title, "uid": folder_uid, "orgId": org_id}
-            response = self.handle_response(requests.post(url, headers=self.headers, data=json.dumps(data)))
+            response = self.handle_response(self.request("POST", url, data=json.dumps(data)))
             if parent_folder_uid: self.move_folder(folder_uid,parent_folder_uid)
             self.logger.debug(f"Created folder {folder_title}")
             return response
@@ -104,20 +136,36 @@ class GrafanaApi:
         self.logger.debug(f"Moving folder {folder_uid} to {parent_folder_uid}")
         url = f"{self.grafana_root_url}/api/folders/{folder_uid}/move"
         data = {"parentUid": parent_folder_uid}
-        response = self.handle_response(requests.post(url, headers=self.headers, data=json.dumps(data)))
+        response = self.handle_response(self.request("POST", url, data=json.dumps(data)))
         self.logger.debug(f"Moved folder {folder_uid} to {parent_folder_uid}")
         return response
     
     def ensure_folder(self,folder_title,folder_uid,parent_folder_uid=None,org_id=1):
-        existing_folders = self.get_folders()
-        folder = next((folder for folder in existing_folders if folder["uid"] == folder_uid), None)
-        if folder is None: folder = self.create_folder(folder_title,folder_uid,parent_folder_uid,org_id)
+        # Look the folder up by uid, the folder list only covers the root level
+        folder = self.get_folder(folder_uid,handle=False)
+        if folder: return self.handle_response(folder)
+        self.create_folder(folder_title,folder_uid,parent_folder_uid,org_id,check_exists=False)
         return self.get_folder(folder_uid)
-            
 
-        
-        
-        
+    def get_folder_tree(self,folder_uid=None):
+        # Walks nested folders breadth first so parents are always listed before their children
+        self.logger.info(f"Getting folder tree under {folder_uid if folder_uid else 'root'}")
+        folders = [self.get_folder(folder_uid)] if folder_uid else []
+        seen = set(folder["uid"] for folder in folders)
+        pending = [folder_uid]
+        while pending:
+            parent_folder_uid = pending.pop(0)
+            listing = self.get_folders(parent_folder_uid)
+            # Without nested folders Grafana ignores parentUid and returns the root list, which holds
+            # the parent itself. Those folders are not its children, the parent is a leaf.
+            if parent_folder_uid is not None and any(child["uid"] == parent_folder_uid for child in listing): continue
+            children = [{**child, "parentUid": parent_folder_uid} for child in listing if child.get("parentUid", parent_folder_uid) == parent_folder_uid and child["uid"] not in seen]
+            seen.update(child["uid"] for child in children)
+            folders.extend(children)
+            pending.extend(child["uid"] for child in children)
+        self.logger.debug(f"Found {len(folders)} folders")
+        return folders
+
 
     ############################################################
     # Folder Permissions
@@ -125,8 +173,8 @@ class GrafanaApi:
         # https://grafana.com/docs/grafana-cloud/developer-resources/api-reference/http-api/folder_permissions/#get-permissions-for-a-folder
         self.logger.info(f"Getting folder permissions for folder {folder_uid}")
         url = f'{self.grafana_root_url}/api/folders/{folder_uid}/permissions'
-        response = self.handle_response(requests.get(url, headers=self.headers))
-        self.logger.debug(f"Found {len(response['items'])} folder permissions")
+        response = self.handle_response(self.request("GET", url))
+        self.logger.debug(f"Found {len(response)} folder permissions")
         return response
     
     def update_folder_permissions(self,folder_uid,items):
@@ -136,29 +184,128 @@ class GrafanaApi:
         data = {
             "items": items
         }
-        response = self.handle_response(requests.post(url, headers=self.headers, data=json.dumps(data)))
+        response = self.handle_response(self.request("POST", url, data=json.dumps(data)))
         self.logger.debug(f"Updated folder permissions for folder {folder_uid}")
         return response
+
+    ############################################################
+    # Dashboards
+    def search_dashboards(self,folder_uids=None,query=None,limit=5000,page=1):
+        # https://grafana.com/docs/grafana-cloud/developer-resources/api-reference/http-api/folder_dashboard_search/
+        self.logger.info(f"Searching dashboards")
+        url = f"{self.grafana_root_url}/api/search"
+        params = {k: v for k, v in {
+            'type': 'dash-db',
+            'folderUIDs': folder_uids,
+            'query': query,
+            'limit': limit,
+            'page': page
+        }.items() if v is not None}
+        response = self.handle_response(self.request("GET", url, params=params))
+        self.logger.debug(f"Found {len(response)} dashboards")
+        return response
+
+    def get_dashboard(self,dashboard_uid):
+        # https://grafana.com/docs/grafana-cloud/developer-resources/api-reference/http-api/dashboard/#get-dashboard-by-uid
+        self.logger.info(f"Getting dashboard {dashboard_uid}")
+        url = f"{self.grafana_root_url}/api/dashboards/uid/{dashboard_uid}"
+        response = self.handle_response(self.request("GET", url))
+        self.logger.debug(f"Got dashboard {dashboard_uid}")
+        return response
+
+    def upsert_dashboard(self,dashboard,folder_uid=None,message=None,overwrite=True):
+        # https://grafana.com/docs/grafana-cloud/developer-resources/api-reference/http-api/dashboard/#create--update-dashboard
+        self.logger.info(f"Upserting dashboard {dashboard.get('uid')}")
+        url = f"{self.grafana_root_url}/api/dashboards/db"
+        dashboard = {k: v for k, v in dashboard.items() if k != "id"}
+        data = {k: v for k, v in {
+            "dashboard": dashboard,
+            "folderUid": folder_uid,
+            "message": message,
+            "overwrite": overwrite
+        }.items() if v is not None}
+        response = self.handle_response(self.request("POST", url, data=json.dumps(data)))
+        self.logger.debug(f"Upserted dashboard {dashboard.get('uid')} {response}")
+        return response
+
+    def delete_dashboard(self,dashboard_uid):
+        # https://grafana.com/docs/grafana-cloud/developer-resources/api-reference/http-api/dashboard/#delete-dashboard-by-uid
+        self.logger.info(f"Deleting dashboard {dashboard_uid}")
+        url = f"{self.grafana_root_url}/api/dashboards/uid/{dashboard_uid}"
+        response = self.handle_response(self.request("DELETE", url))
+        self.logger.debug(f"Deleted dashboard {dashboard_uid}")
+        return response
+
+    ############################################################
+    # Alert Rules
+    def get_alert_rules(self):
+        # https://grafana.com/docs/grafana-cloud/developer-resources/api-reference/http-api/alerting_provisioning/#get-alert-rules
+        self.logger.info(f"Getting alert rules")
+        url = f"{self.grafana_root_url}/api/v1/provisioning/alert-rules"
+        response = self.handle_response(self.request("GET", url))
+        self.logger.debug(f"Found {len(response)} alert rules")
+        return response
+
+    def get_alert_rule(self,rule_uid,handle=True):
+        # https://grafana.com/docs/grafana-cloud/developer-resources/api-reference/http-api/alerting_provisioning/#get-a-specific-alert-rule-by-uid
+        self.logger.debug(f"Getting alert rule {rule_uid}")
+        url = f"{self.grafana_root_url}/api/v1/provisioning/alert-rules/{rule_uid}"
+        response = self.request("GET", url)
+        if handle: response = self.handle_response(response)
+        self.logger.debug(f"Got alert rule {rule_uid}")
+        return response
+
+    def create_alert_rule(self,rule):
+        # https://grafana.com/docs/grafana-cloud/developer-resources/api-reference/http-api/alerting_provisioning/#create-a-new-alert-rule
+        self.logger.info(f"Creating alert rule {rule.get('title')}")
+        url = f"{self.grafana_root_url}/api/v1/provisioning/alert-rules"
+        headers = {**self.headers, 'X-Disable-Provenance': 'true'}
+        response = self.handle_response(self.request("POST", url, headers=headers, data=json.dumps(rule)))
+        self.logger.debug(f"Created alert rule {rule.get('title')} {response}")
+        return response
+
+    def update_alert_rule(self,rule_uid,rule):
+        # https://grafana.com/docs/grafana-cloud/developer-resources/api-reference/http-api/alerting_provisioning/#update-an-existing-alert-rule
+        self.logger.info(f"Updating alert rule {rule_uid}")
+        url = f"{self.grafana_root_url}/api/v1/provisioning/alert-rules/{rule_uid}"
+        headers = {**self.headers, 'X-Disable-Provenance': 'true'}
+        response = self.handle_response(self.request("PUT", url, headers=headers, data=json.dumps(rule)))
+        self.logger.debug(f"Updated alert rule {rule_uid}")
+        return response
+
+    def upsert_alert_rule(self,rule):
+        rule = {k: v for k, v in rule.items() if k not in ("id", "updated", "provenance")}
+        existing_rule = self.get_alert_rule(rule["uid"],handle=False)
+        if existing_rule.status_code == 404: return self.create_alert_rule(rule)
+        return self.update_alert_rule(rule["uid"],rule)
+
     ############################################################
     # Datasources
     def get_datasources(self):
         self.logger.info(f"Getting datasources")
         url = f"{self.grafana_root_url}/api/datasources"
-        response = self.handle_response(requests.get(url, headers=self.headers))
+        response = self.handle_response(self.request("GET", url))
+        self.logger.debug(f"Found {len(response)} datasources")
+        return response
+
+    async def get_datasources_async(self):
+        self.logger.info(f"Getting datasources")
+        url = f"{self.grafana_root_url}/api/datasources"
+        response = self.handle_response(await self.request_async("GET", url))
         self.logger.debug(f"Found {len(response)} datasources")
         return response
         
     def delete_datasource_by_name(self,datasource_name):
         self.logger.info(f"Deleting datasource {datasource_name}")
         url = f"{self.grafana_root_url}/api/datasources/name/{datasource_name}"
-        response = self.handle_response(requests.delete(url, headers=self.headers))
+        response = self.handle_response(self.request("DELETE", url))
         self.logger.debug(f"Deleted datasource {datasource_name}")
         return response
     
     def delete_datasource_by_uid(self,datasource_ui):
         self.logger.info(f"Deleting datasource {datasource_ui}")
         url = f"{self.grafana_root_url}/api/datasources/uid/{datasource_ui}"
-        response = self.handle_response(requests.delete(url, headers=self.headers))
+        response = self.handle_response(self.request("DELETE", url))
         self.logger.debug(f"Deleted datasource {datasource_ui}")
         return response
     
@@ -166,14 +313,14 @@ class GrafanaApi:
     def get_datasource_by_uid(self,datasource_uid):
         self.logger.info(f"Getting datasource {datasource_uid}")
         url = f"{self.grafana_root_url}/api/datasources/uid/{datasource_uid}"
-        response = self.handle_response(requests.get(url, headers=self.headers))
+        response = self.handle_response(self.request("GET", url))
         self.logger.debug(f"Got datasource {datasource_uid}")
         return response
     
     def create_datasource(self,data):
         self.logger.info("Creating datasource")
         url = f"{self.grafana_root_url}/api/datasources"
-        response = self.handle_response(requests.post(url, headers=self.headers, data=json.dumps(data)))
+        response = self.handle_response(self.request("POST", url, data=json.dumps(data)))
         self.logger.debug(f"Created datasource {response}")
         return response
     
@@ -244,14 +391,14 @@ class GrafanaApi:
     def get_team(self,team_id):
         self.logger.info(f"Getting team {team_id}")
         url = f"{self.grafana_root_url}/api/teams/{team_id}"
-        response = self.handle_response(requests.get(url, headers=self.headers))
+        response = self.handle_response(self.request("GET", url))
         self.logger.debug(f"Got team {team_id}")
         return response
 
     def get_teams(self):
         self.logger.info(f"Getting teams")
         url = f"{self.grafana_root_url}/api/teams/search"
-        response = self.handle_response(requests.get(url, headers=self.headers))
+        response = self.handle_response(self.request("GET", url))
         team_count = response["totalCount"]
         self.logger.debug(f"Found {team_count} teams")
         return response['teams']
@@ -260,7 +407,7 @@ class GrafanaApi:
         self.logger.info(f"Creating team {team_name}")
         url = f"{self.grafana_root_url}/api/teams"
         data = {"name": team_name, "orgId": org_id}
-        response = self.handle_response(requests.post(url, headers=self.headers, data=json.dumps(data)))
+        response = self.handle_response(self.request("POST", url, data=json.dumps(data)))
         new_team_id = response["teamId"]
         self.logger.debug(f"Created team {team_name}")
         return self.get_team(new_team_id)
@@ -268,7 +415,7 @@ class GrafanaApi:
     def delete_team(self,team_id):
         self.logger.info(f"Deleting team {team_id}")
         url = f"{self.grafana_root_url}/api/teams/{team_id}"
-        response = self.handle_response(requests.delete(url, headers=self.headers))
+        response = self.handle_response(self.request("DELETE", url))
         self.logger.debug(f"Deleted team {team_id}")
         return response
 
@@ -281,7 +428,7 @@ class GrafanaApi:
         data = {
             "roleUid": role_uid
         }
-        response = self.handle_response(requests.post(url, headers=self.headers, data=json.dumps(data)))
+        response = self.handle_response(self.request("POST", url, data=json.dumps(data)))
         self.logger.debug(f"Added role {role_uid} to team {team_id}")
         return response
     
@@ -293,7 +440,7 @@ class GrafanaApi:
         team_id = str(team["id"])
         url = f"{self.grafana_root_url}/api/access-control/datasources/{datasource_uid}/teams/{team_id}"
         data = {"permission":permission}
-        response = self.handle_response(requests.post(url, headers=self.headers, data=json.dumps(data)))
+        response = self.handle_response(self.request("POST", url, data=json.dumps(data)))
         return response
 
 
@@ -302,7 +449,7 @@ class GrafanaApi:
     def delete_role_datasource_permissions(self,datasource_uid,role_name):
         self.logger.info("Removing role datasource permissions")
         url = f"{self.grafana_root_url}/api/access-control/datasources/{datasource_uid}/builtInRoles/{role_name}"
-        response = self.handle_response(requests.delete(url, headers=self.headers))
+        response = self.handle_response(self.request("DELETE", url))
         return response
     
     def create_role_datasource_permissions(self,datasource_uid,role_name,permission):
@@ -311,5 +458,5 @@ class GrafanaApi:
         url = f"{self.grafana_root_url}/api/access-control/datasources/{datasource_uid}/builtInRoles/{role_name}"
         data = {"permission":permission}
         # Query, Edit Admin
-        response = self.handle_response(requests.post(url, headers=self.headers, data=json.dumps(data)))
+        response = self.handle_response(self.request("POST", url, data=json.dumps(data)))
         return response
\ No newline at end of file
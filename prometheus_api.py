@@ -1,17 +1,45 @@
 import requests
+import asyncio
+from single_flight import SingleFlight, request_key, write_scope
 import sys
 import base64
 
 
 class PrometheusApi:
-    def __init__(self, url, user, token):
+    def __init__(self, url, user, token, rate_limiter=None, transport=None, single_flight=None):
         self.url = url
         self.token = token
         self.user = user
+        self.rate_limiter = rate_limiter
+        self.transport = transport
+        self.single_flight = single_flight if single_flight is not None else SingleFlight()
+        self.session = requests.Session()
         self.headers = {
         'Content-Type': 'application/json',
         'Authorization': 'Basic ' + base64.b64encode(f"{self.user}:{self.token}".encode()).decode()
         }
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("headers", self.headers)
+        if method == "GET":
+            key = request_key(method, url, kwargs.get("params"), kwargs["headers"], self.single_flight.writes(write_scope(self.url, kwargs["headers"])))
+            return self.single_flight.do(key, lambda: self.send(method, url, **kwargs))
+        return self.send(method, url, **kwargs)
+
+    def send(self, method, url, **kwargs):
+        if method != "GET": self.single_flight.record_write(write_scope(self.url, kwargs.get("headers")))
+        if self.rate_limiter is not None: self.rate_limiter.acquire()
+        if self.transport is not None: return self.transport.send(self.session, method, url, **kwargs)
+        return self.session.request(method, url, **kwargs)
+
+    async def request_async(self, method, url, **kwargs):
+        # For asyncio callers, the blocking send runs in the default executor. GETs share in-flight
+        # calls with threaded callers of request().
+        kwargs.setdefault("headers", self.headers)
+        if method == "GET":
+            key = request_key(method, url, kwargs.get("params"), kwargs["headers"], self.single_flight.writes(write_scope(self.url, kwargs["headers"])))
+            return await self.single_flight.do_async(key, lambda: self.send(method, url, **kwargs))
+        return await asyncio.get_running_loop().run_in_executor(None, lambda: self.send(method, url, **kwargs))
  
     def handle_response(self, response):
         response.raise_for_status()
@@ -24,6 +52,12 @@ class PrometheusApi:
     def query(self, query):
         url = f'{self.url}/api/prom/api/v1/query'
         params = {'query': query}
-        response = requests.get(url, headers=self.headers, params=params)
+        response = self.request("GET", url, params=params)
+        return self.handle_response(response)
+
+    async def query_async(self, query):
+        url = f'{self.url}/api/prom/api/v1/query'
+        params = {'query': query}
+        response = await self.request_async("GET", url, params=params)
         return self.handle_response(response)
     
\ No newline at end of file
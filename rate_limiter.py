@@ -0,0 +1,23 @@
+import threading
+import time
+
+
+class RateLimiter:
+    # Token bucket shared by every request a client makes. rate is requests per second,
+    # burst is how many requests may go out back to back after a quiet period.
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst) if burst is not None else max(1.0, self.rate)
+        self.tokens = self.burst
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= 1
+            wait_time = -self.tokens / self.rate if self.tokens < 0 else 0
+        # Sleep outside the lock, the token is already reserved for this caller
+        if wait_time > 0: time.sleep(wait_time)
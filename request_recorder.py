@@ -0,0 +1,137 @@
+import gzip
+import json
+import time
+import threading
+import collections
+import urllib.parse
+import requests
+
+REDACTED = "<redacted>"
+SECRET_KEYS = {"authorization", "token", "password", "basicauthpassword", "securejsondata", "key", "secret", "api_key", "apikey"}
+
+
+class ReplayMiss(Exception):
+    pass
+
+
+def redact(value):
+    if isinstance(value, dict): return {k: REDACTED if k.lower() in SECRET_KEYS else redact(v) for k, v in value.items()}
+    if isinstance(value, list): return [redact(item) for item in value]
+    return value
+
+
+def redact_text(text):
+    # Response bodies are stored parsed when they are JSON so secrets can be stripped by key
+    try: return redact(json.loads(text))
+    except ValueError: return text
+
+
+def normalize_params(params):
+    if not params: return []
+    items = params.items() if isinstance(params, dict) else params
+    normalized = []
+    for key, value in items:
+        if value is None: continue
+        for item in value if isinstance(value, (list, tuple)) else [value]: normalized.append([key, REDACTED if key.lower() in SECRET_KEYS else str(item)])
+    return sorted(normalized)
+
+
+def normalize_body(data):
+    if data is None: return None
+    try: return redact(json.loads(data))
+    except (TypeError, ValueError): return REDACTED
+
+
+def request_keys(method, url, params, body):
+    # The exact key includes the (redacted) body, the loose one is a fallback for bodies that
+    # differ between runs, such as token expiry timestamps
+    loose_key = json.dumps([method, url, params])
+    return json.dumps([method, url, params, body], sort_keys=True), loose_key
+
+
+def call_name(method, url):
+    return f"{method} {urllib.parse.urlparse(url).path}"
+
+
+class RequestRecorder:
+    # Transport that performs requests as usual and appends every request/response pair to a
+    # gzipped JSON lines file, with tokens and passwords redacted
+    def __init__(self, path):
+        self.path = path
+        self.file = gzip.open(path, "wt")
+        self.lock = threading.Lock()
+        self.started_at = time.perf_counter()
+        self.call_counts = collections.Counter()
+
+    def send(self, session, method, url, **kwargs):
+        started_at = time.perf_counter()
+        response = session.request(method, url, **kwargs)
+        elapsed = time.perf_counter() - started_at
+        record = {
+            "method": method,
+            "url": url,
+            "params": normalize_params(kwargs.get("params")),
+            "body": normalize_body(kwargs.get("data")),
+            "status": response.status_code,
+            "content_type": response.headers.get("Content-Type"),
+            "response": redact_text(response.text) if response.text != "" else "",
+            "offset": round(started_at - self.started_at, 6),
+            "elapsed": round(elapsed, 6)
+        }
+        with self.lock:
+            self.file.write(json.dumps(record) + "\n")
+            self.call_counts[call_name(method, url)] += 1
+        return response
+
+    def close(self):
+        with self.lock: self.file.close()
+
+
+class ReplayTransport:
+    # Serves responses from a RequestRecorder file without touching the network. timing="original"
+    # sleeps for each request's recorded duration, timing="zero" returns immediately.
+    def __init__(self, path, timing="zero"):
+        self.timing = timing
+        self.lock = threading.Lock()
+        self.call_counts = collections.Counter()
+        self.records = []
+        self.exact = collections.defaultdict(collections.deque)
+        self.loose = collections.defaultdict(collections.deque)
+        with gzip.open(path, "rt") as file:
+            for line in file:
+                record = json.loads(line)
+                exact_key, loose_key = request_keys(record["method"], record["url"], record["params"], record["body"])
+                self.exact[exact_key].append(len(self.records))
+                self.loose[loose_key].append(len(self.records))
+                self.records.append(record)
+        self.used = [False] * len(self.records)
+
+    def next_record(self, queue):
+        # Matching records are served in recorded order, the last one repeats once the rest are used
+        while len(queue) > 1 and self.used[queue[0]]: queue.popleft()
+        if not queue: return None
+        index = queue.popleft() if len(queue) > 1 else queue[0]
+        self.used[index] = True
+        return self.records[index]
+
+    def send(self, session, method, url, **kwargs):
+        exact_key, loose_key = request_keys(method, url, normalize_params(kwargs.get("params")), normalize_body(kwargs.get("data")))
+        with self.lock:
+            record = self.next_record(self.exact.get(exact_key, collections.deque())) or self.next_record(self.loose.get(loose_key, collections.deque()))
+            self.call_counts[call_name(method, url)] += 1
+        if record is None: raise ReplayMiss(f"No recorded response for {method} {url}")
+        if self.timing == "original": time.sleep(record["elapsed"])
+        return self.build_response(record)
+
+    def build_response(self, record):
+        response = requests.Response()
+        response.status_code = record["status"]
+        response.url = record["url"]
+        response.encoding = "utf-8"
+        if record["content_type"]: response.headers["Content-Type"] = record["content_type"]
+        body = record["response"]
+        response._content = (body if isinstance(body, str) else json.dumps(body)).encode()
+        return response
+
+    def close(self):
+        pass
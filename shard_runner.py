@@ -0,0 +1,50 @@
+import dataclasses
+import re
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from stack_manager import StackManager
+
+
+def shard_configs(config):
+    # Each entry under `shards` overrides the top level config for one org/region, Config
+    # validates them and rejects two shards on the same org and main stack
+    for shard_config in config.shard_configs():
+        if shard_config.dashboards is not None:
+            # Shards run at the same time, each needs its own archive
+            archive_path = shard_archive_path(shard_config.dashboards.archive_path, shard_name(shard_config))
+            shard_config = dataclasses.replace(shard_config, dashboards=dataclasses.replace(shard_config.dashboards, archive_path=archive_path))
+        yield shard_config
+
+
+def shard_name(config):
+    # Built from the org and main stack Config.shard_configs keeps unique, so no two shards share
+    # a name, an archive or a result
+    name = f"{config.org_slug}/{config.main_stack.name}"
+    return f"{name}/{config.region}" if config.region else name
+
+
+def shard_archive_path(archive_path, name):
+    suffix = re.sub(r"[^A-Za-z0-9_.-]+", "-", name)
+    stem, ext = (archive_path[:-len(".tar.gz")], ".tar.gz") if archive_path.endswith(".tar.gz") else (archive_path, "")
+    return f"{stem}-{suffix}{ext}"
+
+
+def run_shard(config, secrets):
+    # Runs in a worker process, so the StackManager and its clients get their own
+    # connection pools and rate limiter
+    stack_manager = StackManager(config, secrets)
+    new_stacks = stack_manager.create_stacks()
+    return [{k: stack.get(k) for k in ("id", "name", "slug", "url", "regionSlug")} for stack in new_stacks]
+
+
+def run_shards(config, secrets, max_workers=None):
+    configs = list(shard_configs(config))
+    max_workers = max_workers or config.max_shard_workers or len(configs)
+    results = {}
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(run_shard, shard_config, secrets.for_org(shard_config.org_slug)): shard_name(shard_config) for shard_config in configs}
+        # Collect shards as they finish so a slow region never holds up the others
+        for future in as_completed(futures):
+            name = futures[future]
+            try: results[name] = {"stacks": future.result(), "error": None}
+            except (Exception, SystemExit) as e: results[name] = {"stacks": [], "error": repr(e)}
+    return results
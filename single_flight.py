@@ -0,0 +1,60 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+
+
+def request_key(method, url, params=None, headers=None, writes=0):
+    # Identical reads are the same method, url, query and credentials, issued after the same
+    # number of writes to that API
+    params = params.items() if isinstance(params, dict) else params or []
+    normalized = tuple(sorted((key, repr(value)) for key, value in params if value is not None))
+    authorization = (headers or {}).get("Authorization")
+    return (method, url, normalized, authorization, writes)
+
+
+def write_scope(base_url, headers=None):
+    # Writes are counted per API and credentials, clients created for the same stack share the count
+    return (base_url, (headers or {}).get("Authorization"))
+
+
+class SingleFlight:
+    # Coalesces concurrent identical calls: the first caller for a key runs fn, every caller that
+    # arrives while it is in flight waits for and shares its result (or exception). Nothing is
+    # cached once the call completes.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.in_flight = {}
+        self.write_counts = {}      # write scope -> writes sent, part of every read key
+
+    def record_write(self, scope):
+        # A read issued after a write never joins a read that started before it and would miss the
+        # write, whichever client instance sent either of them
+        with self.lock: self.write_counts[scope] = self.write_counts.get(scope, 0) + 1
+
+    def writes(self, scope):
+        with self.lock: return self.write_counts.get(scope, 0)
+
+    def join(self, key):
+        with self.lock:
+            future = self.in_flight.get(key)
+            if future is not None: return future, False
+            future = self.in_flight[key] = Future()
+            return future, True
+
+    def run(self, key, future, fn):
+        try: future.set_result(fn())
+        except BaseException as e: future.set_exception(e)
+        finally:
+            with self.lock: self.in_flight.pop(key, None)
+
+    def do(self, key, fn):
+        future, leader = self.join(key)
+        if leader: self.run(key, future, fn)
+        return future.result()
+
+    async def do_async(self, key, fn, executor=None):
+        # fn is blocking, the leader runs it in an executor so the event loop keeps going. Async and
+        # threaded callers share the same in-flight calls.
+        future, leader = self.join(key)
+        if leader: asyncio.get_running_loop().run_in_executor(executor, self.run, key, future, fn)
+        return await asyncio.wrap_future(future)
@@ -1,93 +1,171 @@
 from gcloud_api import GrafanaCloudApi
 from grafana_api import GrafanaApi
 from prometheus_api import PrometheusApi
-import yaml
+from dashboard_archive import export_folder_tree, import_archive
+from rate_limiter import RateLimiter
+from access_policy_index import AccessPolicyIndex
+from request_recorder import RequestRecorder, ReplayTransport, REDACTED
+from single_flight import SingleFlight
+from config_loader import ConfigLoader, ConfigError, Secrets
 import logging
 import os
 import sys
 import datetime
+import argparse
+import signal
 CONFIG_FILE = "config.yml"
 SECRET_FILE = "secrets.yml"
 
 
 
 
-def load_yml(file_path):
-    with open(file_path, 'r') as file:
-        return yaml.safe_load(file)
-   
-
-
-
 
 
 class StackManager:
-    def __init__(self,config,secrets):
+    def __init__(self,config,secrets,transport=None):
         self.config = config
         self.secrets = secrets
+        self.transport = transport
+        # One single-flight group for every client, so concurrent identical reads made by different workers are coalesced
+        self.single_flight = SingleFlight()
         self.logger = self.setup_logger()
-        self.cloud_api = GrafanaCloudApi(secrets["GRAFANA_CLOUD_TOKEN"], self.logger,org_slug=config["org_slug"])
+        self.rate_limiter = RateLimiter(config.rate_limit_per_second) if config.rate_limit_per_second else None
+        self.cloud_api = GrafanaCloudApi(secrets.grafana_cloud_token, self.logger,org_slug=config.org_slug,rate_limiter=self.rate_limiter,transport=self.transport,single_flight=self.single_flight)
         self.stacks = self.cloud_api.get_stacks()
-        self.main_stack_name = config['main_stack']['name']
+        self.main_stack_name = config.main_stack.name
         self.main_stack = [stack for stack in self.stacks["items"] if stack["name"] == self.main_stack_name]
         if not self.main_stack:
             self.logger.error(f"Main stack {self.main_stack_name} not found")
             sys.exit(1)
         else: self.main_stack = self.main_stack[0]
-        self.main_stack_grafana_api = GrafanaApi(secrets["GRAFANA_TOKEN"],self.main_stack["url"],self.logger)
+        # Client stacks live in the shard's region, which defaults to the main stack's. Access policies and
+        # their tokens read the main stack's data, so they live in the main stack's region whatever the shard's.
+        self.region = config.region or self.main_stack["regionSlug"]
+        self.policy_region = self.main_stack["regionSlug"]
+        self.cloud_api.region = self.policy_region
+        self.main_stack_grafana_api = GrafanaApi(secrets.grafana_token,self.main_stack["url"],self.logger,transport=self.transport,single_flight=self.single_flight)
         self.client_info = self.get_clients_from_prometheus(self.stacks,self.main_stack_name)
-            
+        self.policy_index = self.build_policy_index()
+
+    def build_policy_index(self):
+        if not self.config.access_policies.consolidate: return None
+        return AccessPolicyIndex(self.cloud_api,self.main_stack["id"],f'{self.config.org_slug}-clients',self.logger,max_selectors=self.config.access_policies.max_selectors_per_policy)
+
+    def apply_config(self,config,secrets):
+        # Swaps in a reloaded config without rediscovering stacks or clients. The org, main stack and
+        # region are what discovery was based on, changing them needs a restart.
+        if (config.org_slug, config.main_stack.name, config.region) != (self.config.org_slug, self.config.main_stack.name, self.config.region):
+            self.logger.error("org_slug, main_stack.name and region changes need a restart, keeping the running config")
+            return False
+        previous_config = self.config
+        self.config = config
+        self.secrets = secrets
+        self.logger.setLevel(config.log_level)
+        for handler in self.logger.handlers: handler.setLevel(config.log_level)
+        self.rate_limiter = RateLimiter(config.rate_limit_per_second) if config.rate_limit_per_second else None
+        self.cloud_api = GrafanaCloudApi(secrets.grafana_cloud_token, self.logger,org_slug=config.org_slug,region=self.policy_region,rate_limiter=self.rate_limiter,transport=self.transport,single_flight=self.single_flight)
+        self.main_stack_grafana_api = GrafanaApi(secrets.grafana_token,self.main_stack["url"],self.logger,transport=self.transport,single_flight=self.single_flight)
+        if config.access_policies != previous_config.access_policies: self.policy_index = self.build_policy_index()
+        elif self.policy_index is not None: self.policy_index.cloud_api = self.cloud_api
+        self.logger.info("Applied reloaded config")
+        return True
+
     def setup_logger(self):
         self.logger = logging.getLogger(__name__)
-        self.logger.setLevel(self.config["log_level"])
+        if self.logger.handlers: return self.logger    # already set up by an earlier StackManager in this process
+        self.logger.setLevel(self.config.log_level)
         ch = logging.StreamHandler()
-        ch.setLevel(self.config["log_level"])
+        ch.setLevel(self.config.log_level)
         formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
         ch.setFormatter(formatter)
         self.logger.addHandler(ch)
-        log_file_path = self.config["log_file"]
+        log_file_path = self.config.log_file
         if not os.path.exists(log_file_path):
             with open(log_file_path, 'w') as log_file:
                 log_file.write('')
         fh = logging.FileHandler(log_file_path)
-        fh.setLevel(self.config["log_level"])
+        fh.setLevel(self.config.log_level)
         fh.setFormatter(formatter)
         self.logger.addHandler(fh)
-        print(f"Log file created at {self.config['log_file']}")
+        print(f"Log file created at {self.config.log_file}")
         return self.logger
     
     
-    def create_stacks(self,primary_key="client_name",env={'client_environment':"Production"},excludes=None):
-        excludes = self.config["client_names_to_skip"] if not excludes else excludes
-        self.logger.info("Creating stacks")
+    def client_slug(self,client_name):
+        return self.config.client_plan(client_name).slug
+
+    def client_token_name(self,client_name):
+        if self.policy_index is not None and client_name in self.policy_index.client_policy:
+            return self.policy_index.token_name(self.policy_index.client_policy[client_name])
+        return self.config.client_plan(client_name).token_name
+
+    def client_label_selector(self,client_name):
+        return self.config.client_plan(client_name).label_selector
+
+    def get_target_clients(self,primary_key="client_name",env={'client_environment':"Production"},excludes=None):
+        excludes = self.config.excludes if not excludes else set(excludes)
         env_key, env_value = list(env.items())[0]
-        unique_environments = set([client["client_name"] for client in self.client_info.values() if client[env_key] == env_value and client[primary_key] not in excludes])
+        return set([client["client_name"] for client in self.client_info.values() if client[env_key] == env_value and client[primary_key] not in excludes])
+
+    def create_stacks(self,primary_key="client_name",env={'client_environment':"Production"},excludes=None,clients=None):
+        # clients limits the run to a subset of client names, e.g. the ones the drift watcher found out of sync
+        self.logger.info("Creating stacks")
+        unique_environments = self.get_target_clients(primary_key,env,excludes)
+        if clients is not None: unique_environments &= set(clients)
+        if self.policy_index is not None: unique_environments = self.assign_access_policies(unique_environments,self.get_target_clients(primary_key,env,excludes),full_sync=clients is None)
         self.logger.debug(f"Unique environments: {unique_environments}")
+        new_stacks = []
         for environment in unique_environments:
             self.logger.info(f"Creating stack for {environment}")
-            slug = 'fortna-' + environment.lower().replace(" ", "-")
+            slug = self.client_slug(environment)
             
             # Create stack
             self.logger.info(f"Creating stack {environment} with slug {slug}")
-            new_stack = self.cloud_api.upsert_stack(name=environment,slug=slug,region=self.main_stack["regionSlug"],description=f"Stack for {environment}",labels={"client-name": environment, "client-slug": slug, "client-environment": "Production"})
-            new_grafana_api = GrafanaApi(secrets["GRAFANA_TOKEN"],new_stack["url"],self.logger)
-            # Create access policy
-            self.logger.info(f'Creating access policy for {environment}')
-            new_access_policy = self.create_access_policy(new_stack,environment,slug)
-            
-            # Create access policy token
-            self.logger.info(f"Creating access policy token for {environment}")
-            token_name = f"{slug}-token"
-            token_display_name = f"Token for {environment}"
-            token_expire_date = datetime.datetime.now() + datetime.timedelta(days=365)
-            new_token = self.create_access_policy_token(token_name,token_display_name,new_access_policy["id"],new_stack["regionSlug"],token_expire_date)
+            new_stack = self.cloud_api.upsert_stack(name=environment,slug=slug,region=self.region,description=f"Stack for {environment}",labels={"client-name": environment, "client-slug": slug, "client-environment": "Production"})
+            new_grafana_api = GrafanaApi(self.secrets.grafana_token,new_stack["url"],self.logger,transport=self.transport,single_flight=self.single_flight)
+            token_expire_date = datetime.datetime.now() + datetime.timedelta(days=self.config.token_valid_duration_days)
+            if self.policy_index is not None:
+                # Consolidated policies were synced up front, the token is shared with the rest of the policy
+                self.logger.info(f"Using consolidated access policy token for {environment}")
+                new_token = self.policy_index.token_for(self.policy_index.client_policy[environment],token_expire_date)
+            else:
+                # Create access policy
+                self.logger.info(f'Creating access policy for {environment}')
+                new_access_policy = self.create_access_policy(new_stack,environment,slug)
+
+                # Create access policy token
+                self.logger.info(f"Creating access policy token for {environment}")
+                token_name = self.client_token_name(environment)
+                token_display_name = f"Token for {environment}"
+                new_token = self.create_access_policy_token(token_name,token_display_name,new_access_policy["id"],self.policy_region,token_expire_date)
             
             # Create prometheus datasource
             self.logger.info(f"Creating datasource for {environment}")
             self.create_prometheus_datasource(new_grafana_api,environment,slug,self.main_stack["hmInstancePromUrl"],self.main_stack["hmInstancePromId"],new_token)
-         
-       
-            
+            new_stacks.append(new_stack)
+        # Shared tokens that were rotated above are only deleted now that every member datasource has the new one
+        if self.policy_index is not None: self.policy_index.retire_tokens()
+
+        # Copy dashboards and alert rules from the main stack
+        if self.config.dashboards is not None and new_stacks:
+            self.copy_dashboards(new_stacks)
+        return new_stacks
+
+
+    def export_dashboards(self,archive_path,folder_uid=None,include_alert_rules=True):
+        return export_folder_tree(self.main_stack_grafana_api,archive_path,folder_uid,include_alert_rules,self.logger)
+
+    def import_dashboards(self,archive_path,stacks,max_workers=8):
+        # Each client stack gets a prometheus datasource whose uid is the stack slug, see create_stacks
+        main_prometheus_uid = self.config.main_stack.prometheus_datasource_uid
+        targets = [(GrafanaApi(self.secrets.grafana_token,stack["url"],self.logger,transport=self.transport,single_flight=self.single_flight), {main_prometheus_uid: stack["slug"]}) for stack in stacks]
+        return import_archive(archive_path,targets,max_workers=max_workers,logger=self.logger)
+
+    def copy_dashboards(self,stacks):
+        dashboards_config = self.config.dashboards
+        self.logger.info(f"Copying dashboards to {len(stacks)} stacks")
+        self.export_dashboards(dashboards_config.archive_path,dashboards_config.folder_uid,dashboards_config.include_alert_rules)
+        return self.import_dashboards(dashboards_config.archive_path,stacks,dashboards_config.max_workers)
 
 
     def create_prometheus_datasource(self,api,name,uid,url,user,password,org_id=1,is_default=True):
@@ -119,13 +197,28 @@ class StackManager:
         name = f"{slug}-access-policy"
         display_name = f"Access policy - Data from {self.main_stack['name']} for {new_stack['name']} in stack {slug}"
         stack_id = self.main_stack["id"]
-        region = new_stack["regionSlug"]
+        region = self.policy_region
         
-        label_policies = [{"selector":"{client_name=\""+client_name+"\", client_environment=\"Production\"}"}]
+        label_policies = [{"selector":self.client_label_selector(client_name)}]
         new_access_policy = self.cloud_api.upsert_access_policy(name,display_name,label_policies,region,stack_id,realmType="stack",scopes=scopes)
         return new_access_policy
          
 
+    def assign_access_policies(self,clients,target_clients,full_sync=False):
+        # Adds the clients' selectors to the consolidated policies and pushes all changes in one pass.
+        # On a full run clients that are no longer targeted are dropped from their policies.
+        scopes = list(self.config.access_policies.scopes)
+        self.policy_index.load(self.policy_region)
+        if full_sync:
+            for client_name in set(self.policy_index.client_policy) - set(target_clients): self.policy_index.remove(client_name)
+        policy_names = set(self.policy_index.assign(client_name,self.client_label_selector(client_name),self.policy_region,scopes) for client_name in clients)
+        self.policy_index.sync()
+        # A policy's token is rotated when it is used, so every stack sharing it needs its datasource updated
+        # before the old token is retired
+        members = set(clients)
+        for policy_name in policy_names: members |= self.policy_index.members(policy_name)
+        return members & set(target_clients)
+
     def create_access_policy_token(self,token_name,token_display_name,access_policy_id,region,token_expire_date=None):
         new_token = self.cloud_api.upsert_access_policy_token(token_name,token_display_name,access_policy_id,region,token_expire_date)
         return new_token['token']
@@ -144,8 +237,8 @@ class StackManager:
         else: main_stack = main_stack[0]
         promethues_url = main_stack["hmInstancePromUrl"]
         prometheus_user = main_stack["hmInstancePromId"]
-        prometheus_token = secrets.get("PROMETHEUS_TOKEN")
-        prom_api = PrometheusApi(promethues_url,prometheus_user,prometheus_token)
+        prometheus_token = self.secrets.prometheus_token
+        prom_api = PrometheusApi(promethues_url,prometheus_user,prometheus_token,transport=self.transport,single_flight=self.single_flight)
         response = prom_api.query(query_string)
         results = response.get("data", {}).get("result", [])
         clients = {}
@@ -160,7 +253,45 @@ class StackManager:
 
 
  
-config = load_yml(CONFIG_FILE)
-secrets = load_yml(SECRET_FILE)
-stack_manager = StackManager(config,secrets)
-stack_manager.create_stacks()
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Sync Grafana Cloud client stacks")
+    parser.add_argument("--watch", action="store_true", help="keep running and reconcile clients as drift is detected")
+    parser.add_argument("--record", metavar="FILE", help="record every request and response of the run to FILE, secrets redacted")
+    parser.add_argument("--replay", metavar="FILE", help="serve responses from a recording instead of calling the APIs")
+    parser.add_argument("--replay-timing", choices=["zero", "original"], default="zero", help="sleep for each recorded request duration when replaying")
+    args = parser.parse_args()
+    if args.record and args.replay: parser.error("--record and --replay can not be combined")
+    if args.watch and (args.record or args.replay): parser.error("--watch can not be combined with --record or --replay")
+    # Replays don't need real credentials, the recording has them redacted anyway
+    config_loader = ConfigLoader(CONFIG_FILE,SECRET_FILE,placeholder_secrets=Secrets(REDACTED,REDACTED,REDACTED) if args.replay else None)
+    try: config, secrets = config_loader.load()
+    except ConfigError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    if config.shards and (args.watch or args.record or args.replay): parser.error("--watch, --record and --replay run a single StackManager and don't support shards")
+    if args.record or args.replay:
+        transport = RequestRecorder(args.record) if args.record else ReplayTransport(args.replay,args.replay_timing)
+        try:
+            stack_manager = StackManager(config,secrets,transport=transport)
+            stack_manager.create_stacks()
+        finally:
+            transport.close()
+            for call, count in sorted(transport.call_counts.items()): print(f"{count:6d} {call}")
+    elif args.watch:
+        from drift_watcher import DriftWatcher
+        stack_manager = StackManager(config,secrets)
+        stack_manager.create_stacks()
+        watcher = DriftWatcher(stack_manager,config_loader=config_loader)
+        signal.signal(signal.SIGTERM, watcher.stop)
+        signal.signal(signal.SIGINT, watcher.stop)
+        watcher.run()
+    elif config.shards:
+        from shard_runner import run_shards
+        results = run_shards(config,secrets)
+        for shard_name, result in results.items():
+            if result["error"]: print(f"Shard {shard_name} failed: {result['error']}")
+            else: print(f"Shard {shard_name} synced {len(result['stacks'])} stacks")
+        if any(result["error"] for result in results.values()): sys.exit(1)
+    else:
+        stack_manager = StackManager(config,secrets)
+        stack_manager.create_stacks()